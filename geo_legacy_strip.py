@@ -2,18 +2,62 @@
 
 import os
 import sys
+import errno
 import netCDF4
 import argparse
 import re
 import tempfile
 import shutil
+import functools
+import itertools
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
 
 legacy_regex_str =\
     r'ACSPO_([\w\.]+)_(\w+)_(\w+)_(\d{4})-(\d{2})-(\d{2})_(\d{2})(\d{2})-(\d{2})(\d{2})_(\d{8}).(\d{6}).nc'
 
 legacy_regex = re.compile(legacy_regex_str)
 
+# deflate levels. Level 1 is several times faster than the higher levels and, after shuffle and
+# precision reduction, costs only a small increase in file size. Use the archival level for files
+# that are kept long term.
+default_complevel = 1
+archival_complevel = 6
+
+# output compression filters and the netCDF4 flag reporting whether the filter plugin is available.
+# zstd needs the HDF5 filter plugin at read time as well, so zlib remains the default
+compression_filters = {
+    'zlib': None,
+    'zstd': '__has_zstandard_support__',
+}
+default_compression = 'zlib'
+
+# HDF5 chunk cache (size in bytes, number of hash slots, preemption). The default 1 MiB cache is
+# smaller than a single chunk of the larger input layers, which then get inflated more than once. The
+# default cache, used for the input layers, is set before any file is opened and is large enough to
+# hold all the chunks of a typical layer, since output chunks do not line up with input ones.
+# Output tiles are always written whole, so output layers go back to HDF5's 1 MiB default: a larger
+# cache only keeps finished tiles dirty in memory until the file is closed
+default_chunk_cache = (256 * 1024 * 1024, 4133, 0.75)
+output_chunk_cache = (1024 * 1024, 521, 0.75)
+
+netCDF4.set_chunk_cache(*default_chunk_cache)
+
+# output chunk shape: square tiles for 2D layers and chunks of about this many bytes for 1D layers.
+# Tiles of 256x256 give 64-256 KiB chunks, large enough for deflate to find matches while keeping
+# the chunk index small
+chunk_tile_size = 256
+chunk_bytes_1d = 64 * 1024
+
+# attributes that make netCDF4 rescale or mask values on read, so that data read and written back may
+# differ from the stored values
+value_transform_attrs = {'scale_factor', 'add_offset', 'missing_value', 'valid_min', 'valid_max', 'valid_range'}
+
 # precision (number of correct digits for each output layer).
 default_precision_dict = {
     'latitude': 4,
@@ -99,18 +143,314 @@ default_non_hourly_layers = ('pixel_line_number',
                              'sst_regression')
 
 
+'''
+Return the start minute of a legacy file from its name, or None if it is not a legacy file name.
+Names are ACSPO_<version>_<satellite>_<sensor>_YYYY-MM-DD_HHMM-HHMM_YYYYMMDD.HHMMSS.nc and are parsed
+by splitting on underscores; the regex is only used for names that do not split as expected
+'''
+
+
+def legacy_start_minute(name):
+
+    fields = name[:-len('.nc')].split('_')
+
+    if name.startswith('ACSPO_') and name.endswith('.nc') and len(fields) >= 7:
+        version = ''.join(fields[1:-5]).replace('.', '')
+        satellite, sensor, date, times, stamp = fields[-5:]
+
+        if (version.isalnum() and satellite.isalnum() and sensor.isalnum() and
+                len(date) == 10 and date[4] == '-' and date[7] == '-' and
+                (date[:4] + date[5:7] + date[8:]).isdecimal() and
+                len(times) == 9 and times[4] == '-' and (times[:4] + times[5:]).isdecimal() and
+                len(stamp) == 15 and stamp[8] == '.' and (stamp[:8] + stamp[9:]).isdecimal()):
+            return int(times[2:4])
+
+    match = legacy_regex.match(name)
+
+    if not match:
+        return None
+
+    return int(match[8])
+
+
+'''
+Pair each layer name with its precision (least significant digit, None if not reduced)
+'''
+
+
+def layers_with_lsd(layers, precision_dict):
+
+    return tuple((varname, precision_dict.get(varname, None)) for varname in layers)
+
+
+'''
+Quantize floating point data by rounding away trailing mantissa bits (bit shaving with round half to
+even), instead of relying on netCDF4's least_significant_digit rounding. Zeroed bits make the data
+compress much better, and rounding (rather than truncating) keeps the quantization unbiased. The bits
+kept are chosen from the largest finite magnitude, so that the absolute error stays within netCDF4's
+bound of half a unit of 2**-ceil(log2(10**least_significant_digit)) for every element. Non finite
+values are left untouched. data is modified in place and returned
+'''
+
+
+def quantize(data, least_significant_digit):
+
+    finite = np.isfinite(data)
+    largest = max(-np.min(data, where=finite, initial=0.0), np.max(data, where=finite, initial=0.0))
+
+    if largest == 0:
+        return data
+
+    bits = int(np.ceil(np.log2(10.0 ** least_significant_digit)))
+    exponent = int(np.frexp(largest)[1]) - 1
+    mantissa_bits = np.finfo(data.dtype).nmant
+    keep = exponent + bits
+
+    if keep >= mantissa_bits:
+        return data
+
+    uint = np.dtype('u{}'.format(data.dtype.itemsize))
+    drop = mantissa_bits - max(keep, 0)
+    half = uint.type(1 << (drop - 1))
+    mask = ~uint.type((1 << drop) - 1)
+
+    # Adding just under half of the dropped unit, plus the lowest kept bit, before masking rounds to
+    # nearest with ties to even. A carry out of the mantissa correctly moves the value to the next
+    # power of two
+    as_uint = data.view(uint)
+    np.add(as_uint, (half - uint.type(1)) + ((as_uint >> drop) & 1), out=as_uint, where=finite)
+    np.bitwise_and(as_uint, mask, out=as_uint, where=finite)
+
+    return data
+
+
+'''
+Generate index tuples covering an array of the given shape one chunk at a time
+chunks: chunk sizes, as returned by netCDF4.Variable.chunking()
+'''
+
+
+def chunk_slices(shape, chunks):
+
+    if chunks == 'contiguous':
+        chunks = shape
+
+    ranges = [range(0, size, chunk) for size, chunk in zip(shape, chunks)]
+
+    for starts in itertools.product(*ranges):
+        yield tuple(slice(start, start + chunk) for start, chunk in zip(starts, chunks))
+
+
+'''
+Choose output chunk sizes for a layer of the given shape and item size (bytes). Returns None (netCDF
+default chunking) for layers that are neither 1D nor 2D
+'''
+
+
+def pick_chunks(shape, itemsize):
+
+    if len(shape) == 2:
+        return tuple(max(1, min(chunk_tile_size, size)) for size in shape)
+
+    if len(shape) == 1:
+        return (max(1, min(shape[0], chunk_bytes_1d // itemsize)),)
+
+    return None
+
+
+'''
+Keyword arguments for netCDF4.Dataset.createVariable selecting the output compression filter
+'''
+
+
+def compression_kwargs(compression, complevel):
+
+    return dict(compression=compression, complevel=complevel, shuffle=True)
+
+
+'''
+Read the HDF5 filter pipeline of layers of a file and return, for those whose pipeline is exactly
+deflate, optionally preceded by shuffle, a dict of varname: (deflate level, shuffle). Layers with any
+other filter (including ones netCDF4 does not report, such as nbit, scaleoffset or plugin filters)
+are left out. Returns an empty dict if h5py is not available or the file is not HDF5 (netCDF3)
+'''
+
+
+def deflate_pipelines(path, varnames):
+
+    pipelines = {}
+
+    if h5py is None or not h5py.is_hdf5(path):
+        return pipelines
+
+    with h5py.File(path, 'r') as h5_in:
+        for varname in varnames:
+            if not isinstance(h5_in.get(varname), h5py.Dataset):
+                continue
+
+            plist = h5_in[varname].id.get_create_plist()
+            filters = [plist.get_filter(index) for index in range(plist.get_nfilters())]
+            codes = [code for code, _, _, _ in filters]
+
+            if codes == [h5py.h5z.FILTER_DEFLATE]:
+                pipelines[varname] = (filters[0][2][0], False)
+            elif codes == [h5py.h5z.FILTER_SHUFFLE, h5py.h5z.FILTER_DEFLATE]:
+                pipelines[varname] = (filters[1][2][0], True)
+
+    return pipelines
+
+
+'''
+Check whether the compressed chunks of an input layer can be copied verbatim to an output layer
+created with the same chunking and filters (see raw_copy_kwargs), skipping decompression and
+recompression. pipeline is the layer's entry from deflate_pipelines (None if not there). Such
+passthrough layers keep the input deflate level, so they are only copied when the output is deflate
+compressed and the input level is at least the requested one. This also requires no precision
+reduction and a plain (unscaled, unmasked by valid range) integer layer so that filling masked
+values is a no-op
+'''
+
+
+def can_copy_chunks(in_var, least_significant_digit, compression, complevel, pipeline):
+
+    if pipeline is None or least_significant_digit is not None or compression != 'zlib':
+        return False
+
+    if in_var.dtype.kind not in 'iu' or in_var.endian() not in ('native', sys.byteorder):
+        return False
+
+    if in_var.chunking() == 'contiguous':
+        return False
+
+    if set(in_var.ncattrs()) & value_transform_attrs:
+        return False
+
+    return pipeline[0] >= complevel
+
+
+'''
+Keyword arguments for netCDF4.Dataset.createVariable reproducing the chunking and filters of an input
+layer, so that its compressed chunks can be copied verbatim
+'''
+
+
+def raw_copy_kwargs(in_var, pipeline):
+
+    input_complevel, shuffle = pipeline
+
+    return dict(chunksizes=in_var.chunking(), compression='zlib', complevel=input_complevel, shuffle=shuffle)
+
+
+'''
+Copy the compressed chunks of layers from the input file to the (already defined) layers of the
+output file without decompressing them
+'''
+
+
+def copy_raw_chunks(in_path, out_path, varnames):
+
+    with h5py.File(in_path, 'r') as h5_in, h5py.File(out_path, 'r+') as h5_out:
+        for varname in varnames:
+            in_id = h5_in[varname].id
+            out_id = h5_out[varname].id
+
+            for index in range(in_id.get_num_chunks()):
+                offset = in_id.get_chunk_info(index).chunk_offset
+                filter_mask, chunk = in_id.read_direct_chunk(offset)
+                out_id.write_direct_chunk(offset, chunk, filter_mask)
+
+
+'''
+Copy a file and its metadata (like shutil.copy2), letting the kernel move the data. copy_file_range
+can also share the blocks on copy on write file systems. Falls back to sendfile, then to a regular
+buffered copy
+'''
+
+
+def copy_file(src, dst):
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        src_fd = fsrc.fileno()
+        dst_fd = fdst.fileno()
+        size = os.fstat(src_fd).st_size
+        copied = 0
+
+        # Both advance the file positions of dst (and src for copy_file_range), so a later fallback
+        # resumes where the previous method stopped
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    count = os.copy_file_range(src_fd, dst_fd, size - copied)
+                    if count == 0:
+                        break
+                    copied += count
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+
+        if copied < size and hasattr(os, 'sendfile'):
+            try:
+                while copied < size:
+                    count = os.sendfile(dst_fd, src_fd, copied, size - copied)
+                    if count == 0:
+                        break
+                    copied += count
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+
+        if copied < size:
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            shutil.copyfileobj(fsrc, fdst)
+
+    shutil.copystat(src, dst)
+
+
+'''
+Prepare data read from an input layer for writing: fill masked values (NaN for float32) and apply
+precision reduction
+'''
+
+
+def prepare_layer_data(data, least_significant_digit):
+
+    # data was just read from the input file and is not shared, so fill and quantize it in place
+    # rather than allocating new arrays
+    if np.ma.isMaskedArray(data):
+        if data.dtype == np.float32:
+            if data.mask is not np.ma.nomask:
+                np.copyto(data.data, np.nan, where=data.mask)
+            data = data.data
+        elif data.mask is np.ma.nomask or not data.mask.any():
+            data = data.data
+        else:
+            data = data.filled()
+
+    if least_significant_digit is not None and np.issubdtype(data.dtype, np.floating):
+        quantize(data, least_significant_digit)
+
+    return data
+
+
 '''
 Strip uneccessary (for collation) layers from legacy files and reduce precision of remaining layers
 to a reasonable accuracy
 path: path to geo legacy file
-complevel: gzip (deflate) compression level. Must be within [0, 9]
+complevel: gzip (deflate) compression level. Must be within [0, 9]. The default favours speed over
+           size, see archival_complevel for long term storage
+compression: output compression filter, one of compression_filters
 output_dir: Output directory. It not supplied, input will be modified in place (overwritten)
+tmp_dir: directory for the temporary output file. Defaults to the output directory, so that the output
+         is moved in place with a rename. If on another file system, the output is copied instead
 '''
 
 
 def strip_geo_legacy_file(path,
-                          complevel=5,
+                          complevel=default_complevel,
                           output_dir=None,
+                          tmp_dir=None,
+                          compression=default_compression,
                           precision_dict=None,
                           hourly_layers=None,
                           non_hourly_layers=None):
@@ -127,69 +467,131 @@ def strip_geo_legacy_file(path,
     name = os.path.basename(path)
 
     if not os.path.isfile(path):
-        raise IOError('File "{}" does not exist')
+        raise IOError('File "{}" does not exist'.format(path))
 
-    match = legacy_regex.match(name)
+    start_minute = legacy_start_minute(name)
 
-    if not match:
-        raise IOError('File "{}" is not a legacy file')
+    if start_minute is None:
+        raise IOError('File "{}" is not a legacy file'.format(name))
 
     if complevel < 0 or complevel > 9:
         raise ValueError('Invalid commplevel={}. Must be within [0, 9]'.format(complevel))
 
-    is_hourly = int(match[8]) == 0
+    if compression not in compression_filters:
+        raise ValueError('Invalid compression="{}". Must be one of {}'.format(
+            compression, ', '.join(compression_filters)))
+
+    support_flag = compression_filters[compression]
+    if support_flag is not None and not getattr(netCDF4, support_flag, False):
+        raise ValueError('Compression "{}" is not supported by this netCDF4 build'.format(compression))
+
+    is_hourly = start_minute == 0
 
     if is_hourly:
         output_layers = hourly_layers
     else:
         output_layers = non_hourly_layers
 
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        tmp_path = os.path.join(tmp_dir, name)
-        with netCDF4.Dataset(tmp_path, 'w') as ncf_tmp, netCDF4.Dataset(path, 'r') as ncf_in:
+    output_layers = layers_with_lsd(output_layers, precision_dict)
+
+    if output_dir:
+        out_path = os.path.join(output_dir, name)
+    else:
+        out_path = path
+
+    # Replace the file a symbolic link points to rather than the link itself. Hard links to the
+    # output are not kept: the rename gives it a new inode
+    out_path = os.path.realpath(out_path)
+
+    if not tmp_dir:
+        tmp_dir = os.path.dirname(out_path)
+
+    tmp_fd, tmp_path = tempfile.mkstemp(prefix='.{}.'.format(name), suffix='.tmp', dir=tmp_dir)
+    os.close(tmp_fd)
+
+    try:
+        # Filters of the input layers, as seen by HDF5, to find the ones that can be copied verbatim
+        if compression == 'zlib':
+            pipelines = deflate_pipelines(path, [varname for varname, _ in output_layers])
+        else:
+            pipelines = {}
+
+        # The output is built in memory and written to tmp_path in one go when closed, instead of
+        # through the many small writes HDF5 issues while the file grows
+        with netCDF4.Dataset(tmp_path, 'w', diskless=True, persist=True) as ncf_tmp, \
+                netCDF4.Dataset(path, 'r') as ncf_in:
 
             dims = ncf_in.dimensions
 
             for dim_name, dim in dims.items():
                 ncf_tmp.createDimension(dim.name, size=dim.size)
 
-            for att_name in ncf_in.ncattrs():
-                ncf_tmp.setncattr(att_name, ncf_in.getncattr(att_name))
+            ncf_tmp.setncatts({att_name: ncf_in.getncattr(att_name) for att_name in ncf_in.ncattrs()})
+
+            # Define all output layers and their attributes before writing any data, so that the file
+            # does not switch between define and data mode
+            raw_copy_layers = []
+            copy_layers = []
 
-            for varname in output_layers:
+            for varname, least_significant_digit in output_layers:
 
                 try:
                     in_var = ncf_in.variables[varname]
                 except Exception as e:
                     raise IOError('File "{}" is missing layer "{}": {}'.format(name, varname, str(e)))
-                least_significant_digit = precision_dict.get(varname, None)
+
+                # Layers copied verbatim (with h5py, once both files are closed) keep the input
+                # chunking and filters, the others are rechunked and recompressed
+                pipeline = pipelines.get(varname)
+                raw_copy = can_copy_chunks(in_var, least_significant_digit, compression, complevel, pipeline)
+
+                if raw_copy:
+                    var_kwargs = raw_copy_kwargs(in_var, pipeline)
+                else:
+                    var_kwargs = compression_kwargs(compression, complevel)
+                    var_kwargs['chunksizes'] = pick_chunks(in_var.shape, in_var.dtype.itemsize)
 
                 out_var = ncf_tmp.createVariable(varname,
                                                  in_var.datatype,
                                                  in_var.dimensions,
-                                                 zlib=True,
-                                                 complevel=complevel,
-                                                 shuffle=True,
-                                                 least_significant_digit=least_significant_digit)
-
-                for att_name in in_var.ncattrs():
-                    out_var.setncattr(att_name, in_var.getncattr(att_name))
-
-                data = in_var[:]
-                if np.ma.isMaskedArray(data):
-                    if data.dtype == np.float32:
-                        data = data.filled(fill_value=np.nan)
-                    else:
-                        data = data.filled()
-
-                out_var[:] = data
-
-        if output_dir:
-            out_path = os.path.join(output_dir, name)
-        else:
-            out_path = path
-
-        shutil.copy2(tmp_path, out_path)
+                                                 **var_kwargs)
+
+                atts = {att_name: in_var.getncattr(att_name) for att_name in in_var.ncattrs()}
+                if least_significant_digit is not None:
+                    atts['least_significant_digit'] = least_significant_digit
+                out_var.setncatts(atts)
+
+                if raw_copy:
+                    raw_copy_layers.append(varname)
+                else:
+                    copy_layers.append((in_var, out_var, least_significant_digit))
+
+            # Copy one output chunk at a time rather than whole layers, so that the data read, filled
+            # and quantized in numpy is one chunk at a time. The process memory is not bounded by a
+            # chunk: the compressed output file is held in memory until it is closed (diskless), and
+            # an input layer caches up to default_chunk_cache bytes of inflated chunks until released
+            for in_var, out_var, least_significant_digit in copy_layers:
+                out_var.set_var_chunk_cache(*output_chunk_cache)
+                for s in chunk_slices(in_var.shape, out_var.chunking()):
+                    out_var[s] = prepare_layer_data(in_var[s], least_significant_digit)
+                # Layers stay open until the file is closed, release the cached input chunks
+                in_var.set_var_chunk_cache(size=0)
+
+        if raw_copy_layers:
+            copy_raw_chunks(path, tmp_path, raw_copy_layers)
+
+        # mkstemp creates the file readable by the owner only, use the permissions of the input
+        shutil.copymode(path, tmp_path)
+
+        try:
+            os.replace(tmp_path, out_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            copy_file(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
     return
 
@@ -205,17 +607,64 @@ def main():
                         default='',
                         type=str,
                         help='Output directory. Iinput files will be overwritten ifno output directory is given')
-    parser.add_argument('--compress_level', default=5, type=int, help='Output compression level')
+    parser.add_argument('--tmp_dir',
+                        default='',
+                        type=str,
+                        help='Directory for temporary files. Defaults to the output directory')
+    parser.add_argument('--compress_level',
+                        default=None,
+                        type=int,
+                        help='Output compression level. Defaults to {} ({} with --archival). Integer '
+                             'layers already deflated at this level or higher are copied as is'.format(
+                            default_complevel, archival_complevel))
+    parser.add_argument('--archival',
+                        action='store_true',
+                        help='Favour output size over speed (compression level {})'.format(archival_complevel))
+    parser.add_argument('--compression',
+                        default=default_compression,
+                        choices=list(compression_filters),
+                        help='Output compression filter. zstd requires the HDF5 filter plugin to read '
+                             'the output')
+    parser.add_argument('--jobs',
+                        default=os.cpu_count(),
+                        type=int,
+                        help='Number of files processed in parallel. Defaults to the number of CPUs')
 
     args = parser.parse_args()
 
     files = args.files
     output_dir = args.output_dir
+    tmp_dir = args.tmp_dir
     compress_level = args.compress_level
-
-    for path in files:
-        print('Stripping file "{}"'.format(os.path.basename(path)))
-        strip_geo_legacy_file(path, complevel=compress_level, output_dir=output_dir)
+    compression = args.compression
+    jobs = args.jobs
+
+    if compress_level is None:
+        compress_level = archival_complevel if args.archival else default_complevel
+
+    if jobs < 1:
+        parser.error('Invalid jobs={}. Must be at least 1'.format(jobs))
+
+    strip = functools.partial(strip_geo_legacy_file,
+                              complevel=compress_level,
+                              output_dir=output_dir,
+                              tmp_dir=tmp_dir,
+                              compression=compression)
+
+    # Files are independent and the work is dominated by zlib, so use processes rather than
+    # threads (HDF5 is not thread safe). Each worker opens its own Datasets and temporary file.
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(strip, path) for path in files]
+
+        for path, future in zip(files, futures):
+            try:
+                future.result()
+            except BaseException:
+                # Stop at the first failure: queued files are cancelled, the few already handed to the
+                # worker processes are finished before the error is raised
+                executor.shutdown(cancel_futures=True)
+                raise
+            print('Stripped file "{}"'.format(os.path.basename(path)))
 
     return 0
 
@@ -0,0 +1,194 @@
+import numpy as np
+import pytest
+
+import geo_legacy_strip
+
+
+def error_bound(least_significant_digit):
+
+    return 0.5 * 2.0 ** -np.ceil(np.log2(10.0 ** least_significant_digit))
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('scale', [1e-3, 1.0, 300.0, 1e5])
+@pytest.mark.parametrize('least_significant_digit', [2, 3, 4])
+def test_quantize_error_bound(dtype, scale, least_significant_digit):
+
+    rng = np.random.default_rng(0)
+    data = (rng.uniform(-1.0, 1.0, 100000) * scale).astype(dtype)
+
+    quantized = geo_legacy_strip.quantize(data.copy(), least_significant_digit)
+
+    error = np.abs(quantized.astype(np.float64) - data.astype(np.float64))
+    assert error.max() <= error_bound(least_significant_digit)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_quantize_unbiased(dtype):
+
+    rng = np.random.default_rng(0)
+    data = rng.uniform(280.0, 300.0, 1000000).astype(dtype)
+
+    quantized = geo_legacy_strip.quantize(data.copy(), 3)
+
+    error = quantized.astype(np.float64) - data.astype(np.float64)
+    assert abs(error.mean()) < 1e-3 * error_bound(3)
+
+
+def test_quantize_zeroes_trailing_bits():
+
+    data = np.linspace(280.0, 300.0, 1000, dtype=np.float32)
+
+    quantized = geo_legacy_strip.quantize(data.copy(), 3)
+
+    assert np.all(quantized.view(np.uint32) & 0x1f == 0)
+
+
+def test_quantize_non_finite_passthrough():
+
+    data = np.array([np.nan, np.inf, -np.inf, 290.123456, -12.3456789], dtype=np.float32)
+    expected_bits = data.view(np.uint32)[:3].copy()
+
+    quantized = geo_legacy_strip.quantize(data, 3)
+
+    assert np.array_equal(quantized.view(np.uint32)[:3], expected_bits)
+    assert np.all(np.abs(quantized[3:] - np.array([290.123456, -12.3456789])) <= error_bound(3))
+
+
+def test_quantize_all_non_finite():
+
+    data = np.array([np.nan, np.inf], dtype=np.float32)
+    expected_bits = data.view(np.uint32).copy()
+
+    quantized = geo_legacy_strip.quantize(data, 3)
+
+    assert np.array_equal(quantized.view(np.uint32), expected_bits)
+
+
+def test_deflate_pipelines(tmp_path):
+
+    h5py = pytest.importorskip('h5py')
+
+    path = str(tmp_path / 'layers.h5')
+    data = np.arange(1000, dtype=np.int16).reshape(10, 100)
+
+    with h5py.File(path, 'w') as h5_out:
+        h5_out.create_dataset('shuffle_deflate', data=data, chunks=(5, 100), shuffle=True, compression='gzip',
+                              compression_opts=4)
+        h5_out.create_dataset('deflate', data=data, chunks=(5, 100), compression='gzip', compression_opts=2)
+        h5_out.create_dataset('scaleoffset_deflate', data=data, chunks=(5, 100), scaleoffset=0,
+                              compression='gzip')
+        h5_out.create_dataset('fletcher32_deflate', data=data, chunks=(5, 100), fletcher32=True,
+                              compression='gzip')
+        h5_out.create_dataset('lzf', data=data, chunks=(5, 100), compression='lzf')
+        h5_out.create_dataset('contiguous', data=data)
+        h5_out.create_group('group')
+
+    varnames = ['shuffle_deflate', 'deflate', 'scaleoffset_deflate', 'fletcher32_deflate', 'lzf', 'contiguous',
+                'group', 'missing']
+
+    assert geo_legacy_strip.deflate_pipelines(path, varnames) == {'shuffle_deflate': (4, True),
+                                                                  'deflate': (2, False)}
+
+
+def test_deflate_pipelines_netcdf3(tmp_path):
+
+    pytest.importorskip('h5py')
+    netCDF4 = pytest.importorskip('netCDF4')
+
+    path = str(tmp_path / 'layers.nc')
+
+    with netCDF4.Dataset(path, 'w', format='NETCDF3_CLASSIC') as ncf_out:
+        ncf_out.createDimension('x', 10)
+        ncf_out.createVariable('layer', np.int16, ('x',))[:] = np.arange(10)
+
+    assert geo_legacy_strip.deflate_pipelines(path, ['layer']) == {}
+
+
+@pytest.mark.parametrize('complevel', [1, 4, 6])
+def test_strip_round_trip(tmp_path, complevel):
+
+    pytest.importorskip('h5py')
+    netCDF4 = pytest.importorskip('netCDF4')
+
+    name = 'ACSPO_V2.41_H08_AHI_2016-01-01_0000-0010_20160101.012345.nc'
+    in_dir = tmp_path / 'in'
+    out_dir = tmp_path / 'out'
+    in_dir.mkdir()
+    out_dir.mkdir()
+
+    data = np.arange(100 * 120, dtype=np.int16).reshape(100, 120) % 1000
+    in_chunks = [50, 60]
+
+    with netCDF4.Dataset(str(in_dir / name), 'w') as ncf_out:
+        ncf_out.createDimension('y', 100)
+        ncf_out.createDimension('x', 120)
+        for varname in ('plain', 'scaled'):
+            var = ncf_out.createVariable(varname, np.int16, ('y', 'x'), compression='zlib', complevel=4,
+                                         shuffle=True, chunksizes=in_chunks)
+            if varname == 'scaled':
+                var.setncatts({'valid_min': np.int16(0), 'scale_factor': 0.01})
+            var.set_auto_maskandscale(False)
+            var[:] = data
+
+    geo_legacy_strip.strip_geo_legacy_file(str(in_dir / name),
+                                           complevel=complevel,
+                                           output_dir=str(out_dir),
+                                           precision_dict={},
+                                           hourly_layers=('plain', 'scaled'))
+
+    with netCDF4.Dataset(str(out_dir / name), 'r') as ncf_in:
+        ncf_in.set_auto_maskandscale(False)
+
+        for varname in ('plain', 'scaled'):
+            assert np.array_equal(ncf_in.variables[varname][:], data)
+
+        plain = ncf_in.variables['plain']
+        scaled = ncf_in.variables['scaled']
+
+        # Copied verbatim while the input level (4) is at least the requested one, recompressed otherwise
+        if complevel <= 4:
+            assert plain.chunking() == in_chunks
+            assert plain.filters()['complevel'] == 4
+        else:
+            assert plain.chunking() != in_chunks
+            assert plain.filters()['complevel'] == complevel
+
+        # valid_min and scale_factor change values on read, so the layer is always rewritten
+        assert scaled.chunking() != in_chunks
+        assert scaled.filters()['complevel'] == complevel
+
+
+@pytest.mark.parametrize('name', [
+    'ACSPO_V2.41_H08_AHI_2016-01-01_0000-0010_20160101.012345.nc',
+    'ACSPO_V2.41_H08_AHI_2016-01-01_0010-0020_20160101.012345.nc',
+    'ACSPO_V2.41_H08_AHI_2016-01-01_2350-0000_20160101.012345.nc',
+    'ACSPO_V2.41B04_G16_ABI_2018-06-30_1230-1240_20180630.134501.nc',
+    'ACSPO_V2_41_H08_AHI_2016-01-01_0130-0140_20160101.012345.nc',
+    'ACSPO_V2.41_H08_AHI_2016-01-01_0130-0140_20160101.012345.nc.bak',
+    'ACSPO_V2.41_H08_AHI_2016-01-01_0130-0140_20160101.012345.nc4',
+    'ACSPO_V2.41_H08_AHI_2016-01-01_0130-0140_20160101x012345.nc',
+    'ACSPO_V2.41_H08_AHI_2016-01-01_0130-0140_20160101.012345xnc',
+    'ACSPO_V2.41_H_08_AHI_2016-01-01_0130-0140_20160101.012345.nc',
+])
+def test_legacy_start_minute_matches_regex(name):
+
+    match = geo_legacy_strip.legacy_regex.match(name)
+
+    assert geo_legacy_strip.legacy_start_minute(name) == int(match[8])
+
+
+@pytest.mark.parametrize('name', [
+    'foo.nc',
+    'ACSPO_x.nc',
+    'ACSPO_V2.41_H08_AHI_2016-01-01_0130_20160101.012345.nc',
+    'ACSPO_V2.41_H08_AHI_2016-1-01_0130-0140_20160101.012345.nc',
+    'ACSPO_V2.41_H08_AHI_2016-01-01_01a0-0140_20160101.012345.nc',
+    'ACSPO_V2.41_H08_2016-01-01_0130-0140_20160101.012345.nc',
+    'ACSPO__H08_AHI_2016-01-01_0130-0140_20160101.012345.nc',
+    'ACSPO_V2.41_H08_AHI_2016-01-01_0130-0140_20160101.01234.nc',
+])
+def test_legacy_start_minute_rejects_non_legacy_names(name):
+
+    assert geo_legacy_strip.legacy_regex.match(name) is None
+    assert geo_legacy_strip.legacy_start_minute(name) is None